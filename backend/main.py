@@ -1,14 +1,37 @@
 # backend/main.py
 import asyncio
+import bisect
+import itertools
 import random
 import uuid
-from typing import Dict, List
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+import orjson
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from datetime import datetime, timezone
 
-app = FastAPI(title="SIMGuard Central - Demo")
+# Run the simulator and its helpers for the lifetime of the app
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # set when sims/registered change; state_broadcaster pushes them out.
+    # Created here so it belongs to the running loop, not the import-time one.
+    app.state.state_dirty = asyncio.Event()
+    # keep references so the tasks aren't garbage-collected and can be cancelled
+    app.state.background_tasks = {
+        asyncio.create_task(clock_ticker()),
+        asyncio.create_task(simulator_loop()),
+        asyncio.create_task(state_broadcaster()),
+    }
+    yield
+    for task in app.state.background_tasks:
+        task.cancel()
+    await asyncio.gather(*app.state.background_tasks, return_exceptions=True)
+
+app = FastAPI(title="SIMGuard Central - Demo", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Allow local frontend to connect (demo). Tighten origins in production.
 app.add_middleware(
@@ -21,45 +44,100 @@ app.add_middleware(
 
 # In-memory demo datastore (replace with DB for production)
 state = {
-    "sims": [
+    "sims": deque([
         {"id":"sim-0825550101","number":"082 555 0101","locked":True,"last":"No issues in 12h"},
         {"id":"sim-0825550102","number":"082 555 0102","locked":False,"last":"Unlocked by user 2h ago"},
         {"id":"sim-0812227788","number":"081 222 7788","locked":True,"last":"Auto-locked on risk spike"}
-    ],
+    ]),
     "registered": [
         {"id":"reg-0601239999","number":"060 123 9999","relation":"Unknown","risk":"high"},
         {"id":"reg-0724001100","number":"072 400 1100","relation":"Old device","risk":"medium"},
         {"id":"reg-0825550102","number":"082 555 0102","relation":"Primary","risk":"low"}
     ],
-    "alerts": [
+    "alerts": deque([
         {"id":str(uuid.uuid4()), "ts":datetime.now(timezone.utc).isoformat(), "text":"System ready. Monitoring enabled.", "level":"info"}
-    ],
-    "activity": []
+    ], maxlen=200),
+    "activity": deque(maxlen=200)
 }
+# id -> sim index so lookups don't scan the SIM list
+state["sims_by_id"] = {s["id"]: s for s in state["sims"]}
+# ids for alert/activity entries; only need to be unique, not random
+state["_seq"] = itertools.count()
+# bumped via bump_version() on every state change; drives the /sims ETag
+# and the cached WS init frame
+state["_version"] = 0
+# per-process ETag prefix so a restarted server never matches an old tag
+_ETAG_BOOT = uuid.uuid4().hex[:8]
+# encoded WS init frame, reused until _version moves on
+state["_init_cache_bytes"] = None
+state["_init_cache_version"] = -1
 
 # WebSocket manager to broadcast alerts
 class ConnectionManager:
     def __init__(self):
-        self.active: List[WebSocket] = []
+        # each client gets its own bounded outbound queue drained by a relay task,
+        # so a slow client can't hold up broadcasts to everyone else
+        self.active: Dict[WebSocket, asyncio.Queue] = {}
+        self.relays: Dict[WebSocket, asyncio.Task] = {}
+        # broadcasts made during the current loop tick, flushed as one frame
+        self.pending: List[Dict] = []
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active.append(websocket)
+        # deliver already-buffered broadcasts to existing clients only; the
+        # newcomer's init frame already reflects them
+        self._flush()
+        queue = asyncio.Queue(maxsize=32)
+        self.active[websocket] = queue
+        self.relays[websocket] = asyncio.create_task(self._relay(websocket, queue))
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active:
-            self.active.remove(websocket)
+        self.active.pop(websocket, None)
+        relay = self.relays.pop(websocket, None)
+        if relay:
+            relay.cancel()
 
-    async def broadcast(self, message: Dict):
-        living = []
-        for ws in list(self.active):
+    async def _relay(self, websocket: WebSocket, queue: asyncio.Queue):
+        while True:
+            payload = await queue.get()
             try:
-                await ws.send_json(message)
-                living.append(ws)
+                await websocket.send_bytes(payload)
             except Exception:
-                # ignore broken connections
-                pass
-        self.active = living
+                # broken connection; stop relaying to it
+                break
+        self.active.pop(websocket, None)
+        self.relays.pop(websocket, None)
+
+    @staticmethod
+    def _enqueue(queue: asyncio.Queue, payload: bytes):
+        if queue.full():
+            # slow client: drop its oldest pending message rather than block
+            queue.get_nowait()
+        queue.put_nowait(payload)
+
+    def send(self, websocket: WebSocket, message: Dict):
+        self.send_payload(websocket, orjson.dumps(message))
+
+    def send_payload(self, websocket: WebSocket, payload: bytes):
+        queue = self.active.get(websocket)
+        if queue is not None:
+            self._enqueue(queue, payload)
+
+    def broadcast(self, message: Dict):
+        self.pending.append(message)
+        if len(self.pending) == 1:
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        message = pending[0] if len(pending) == 1 else {"type":"batch","payload": pending}
+        # encode once and hand the same UTF-8 JSON bytes to every client;
+        # sent as binary frames so they aren't decoded/re-encoded per send
+        payload = orjson.dumps(message)
+        for queue in self.active.values():
+            self._enqueue(queue, payload)
 
 manager = ConnectionManager()
 
@@ -72,50 +150,78 @@ class RecoveryRequest(BaseModel):
     sim_id: str
     step: str
 
+# Risk levels with precomputed cumulative weights (60/30/10)
+_RISK_LABELS = ("Low", "Medium", "High")
+_RISK_CUM = (0.6, 0.9, 1.0)
+
 # Helpers
+# UTC timestamp refreshed once a second by clock_ticker, so hot paths
+# reuse one string instead of formatting a datetime per event
+_NOW_ISO = datetime.now(timezone.utc).isoformat()
+
 def now_iso():
-    return datetime.now(timezone.utc).isoformat()
+    return _NOW_ISO
+
+async def clock_ticker():
+    global _NOW_ISO
+    while True:
+        _NOW_ISO = datetime.now(timezone.utc).isoformat()
+        await asyncio.sleep(1)
 
-def add_log(text: str):
-    entry = {"id": str(uuid.uuid4()), "ts": now_iso(), "text": text}
-    state["activity"].insert(0, entry)
-    state["activity"] = state["activity"][:200]
+def bump_version():
+    state["_version"] += 1
 
-def add_alert(text: str, level: str = "warn"):
-    entry = {"id": str(uuid.uuid4()), "ts": now_iso(), "text": text, "level": level}
-    state["alerts"].insert(0, entry)
-    state["alerts"] = state["alerts"][:200]
+def add_log(text: str, ts: Optional[str] = None):
+    entry = {"id": str(next(state["_seq"])), "ts": ts or now_iso(), "text": text}
+    bump_version()
+    state["activity"].appendleft(entry)
+
+def add_alert(text: str, level: str = "warn", ts: Optional[str] = None):
+    entry = {"id": str(next(state["_seq"])), "ts": ts or now_iso(), "text": text, "level": level}
+    bump_version()
+    state["alerts"].appendleft(entry)
     return entry
 
+def init_frame() -> bytes:
+    if state["_init_cache_version"] != state["_version"]:
+        state["_init_cache_bytes"] = orjson.dumps({"type":"init","payload": {"sims": list(state["sims"]), "registered": state["registered"], "alerts": list(state["alerts"]), "activity": list(state["activity"])}})
+        state["_init_cache_version"] = state["_version"]
+    return state["_init_cache_bytes"]
+
 def find_sim(sim_id: str):
-    for sim in state["sims"]:
-        if sim["id"] == sim_id:
-            return sim
-    return None
+    return state["sims_by_id"].get(sim_id)
 
 # REST endpoints
 @app.get("/sims")
-async def get_sims():
-    return {"sims": state["sims"], "registered": state["registered"], "alerts": state["alerts"], "activity": state["activity"]}
+async def get_sims(request: Request):
+    etag = f'W/"{_ETAG_BOOT}-{state["_version"]}"'
+    if request.headers.get("if-none-match") == etag:
+        # nothing changed since the client's copy; skip serialization entirely
+        return Response(status_code=304, headers={"ETag": etag})
+    # returned as a response directly so FastAPI skips jsonable_encoder
+    return ORJSONResponse({"sims": list(state["sims"]), "registered": state["registered"], "alerts": list(state["alerts"]), "activity": list(state["activity"])}, headers={"ETag": etag})
 
 @app.post("/action")
 async def take_action(action: Action):
     sim = find_sim(action.sim_id)
     if not sim:
         return {"error": "SIM not found"}
+    ts = now_iso()
     if action.action == "lock":
         sim["locked"] = True
-        sim["last"] = "Locked by user • " + now_iso()
-        add_log(f"{sim['number']} locked via API")
-        alert = add_alert(f"SIM {sim['number']} locked by user", "info")
-        await manager.broadcast({"type":"alert","payload": alert})
+        sim["last"] = f"Locked by user • {ts}"
+        bump_version()
+        add_log(f"{sim['number']} locked via API", ts=ts)
+        alert = add_alert(f"SIM {sim['number']} locked by user", "info", ts=ts)
+        manager.broadcast({"type":"alert","payload": alert})
         return {"status":"locked","sim":sim}
     elif action.action == "unlock":
         sim["locked"] = False
-        sim["last"] = "Unlocked by user • " + now_iso()
-        add_log(f"{sim['number']} unlocked via API")
-        alert = add_alert(f"SIM {sim['number']} unlocked by user", "warn")
-        await manager.broadcast({"type":"alert","payload": alert})
+        sim["last"] = f"Unlocked by user • {ts}"
+        bump_version()
+        add_log(f"{sim['number']} unlocked via API", ts=ts)
+        alert = add_alert(f"SIM {sim['number']} unlocked by user", "warn", ts=ts)
+        manager.broadcast({"type":"alert","payload": alert})
         return {"status":"unlocked","sim":sim}
     return {"error":"unknown action"}
 
@@ -127,30 +233,31 @@ async def recovery(req: RecoveryRequest):
     step = req.step
     if step == "freeze":
         sim["locked"] = True
+        bump_version()
         alert = add_alert(f"Recovery: SIM {sim['number']} frozen via wizard", "info")
         add_log(f"Recovery freeze for {sim['number']}")
-        await manager.broadcast({"type":"alert","payload": alert})
+        manager.broadcast({"type":"alert","payload": alert})
         return {"ok":True}
     elif step == "reset":
         alert = add_alert(f"Recovery: password reset initiated for {sim['number']}", "warn")
         add_log(f"Recovery reset triggered for {sim['number']}")
-        await manager.broadcast({"type":"alert","payload": alert})
+        manager.broadcast({"type":"alert","payload": alert})
         return {"ok":True}
     elif step == "notify-bank":
         alert = add_alert(f"Recovery: bank partners notified for {sim['number']}", "warn")
         add_log(f"Recovery notify-bank for {sim['number']}")
-        await manager.broadcast({"type":"alert","payload": alert})
+        manager.broadcast({"type":"alert","payload": alert})
         return {"ok":True}
     elif step == "open-case":
         ref = random.randint(10000,99999)
         alert = add_alert(f"Recovery: Telco case opened for {sim['number']} (Ref #{ref})", "danger")
         add_log(f"Recovery open-case for {sim['number']} ref {ref}")
-        await manager.broadcast({"type":"alert","payload": alert})
+        manager.broadcast({"type":"alert","payload": alert})
         return {"ok":True}
     elif step == "police":
         alert = add_alert(f"Recovery: SAPS note generated for {sim['number']}", "danger")
         add_log(f"Recovery police note for {sim['number']}")
-        await manager.broadcast({"type":"alert","payload": alert})
+        manager.broadcast({"type":"alert","payload": alert})
         return {"ok":True}
     return {"error":"unknown step"}
 
@@ -159,7 +266,7 @@ async def risk_score(sim_id: str):
     sim = find_sim(sim_id)
     if not sim:
         return {"error":"SIM not found"}
-    score = random.choices(["Low","Medium","High"], weights=[60,30,10])[0]
+    score = _RISK_LABELS[bisect.bisect(_RISK_CUM, random.random())]
     return {"sim_id": sim_id, "risk": score}
 
 # WebSocket endpoint
@@ -168,45 +275,61 @@ async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     try:
         # send initial state
-        await websocket.send_json({"type":"init","payload": {"sims": state["sims"], "registered": state["registered"], "alerts": state["alerts"], "activity": state["activity"]}})
+        manager.send_payload(websocket, init_frame())
         while True:
             # keep connection alive; accept optional pings from client
             data = await websocket.receive_text()
-            await asyncio.sleep(0.01)
+            if data == "ping":
+                manager.send(websocket, {"type":"pong"})
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
 # Background simulator (auto events)
+# Every (branch, delay) pair for one tick: 60% swap attempts / 40% new
+# registrations (3:2 copies each), delay uniform over 10-25s, so a single
+# random.choice draws both
+_SIM_TICKS = tuple(
+    [("swap", d) for d in range(10, 26) for _ in range(3)]
+    + [("register", d) for d in range(10, 26) for _ in range(2)]
+)
 async def simulator_loop():
     while True:
-        await asyncio.sleep(random.randint(10, 25))
-        choice = random.random()
-        if choice < 0.6:
+        branch, delay = random.choice(_SIM_TICKS)
+        await asyncio.sleep(delay)
+        if branch == "swap":
             sim = random.choice(state["sims"])
             add_log(f"Suspicious SIM-swap attempt detected for {sim['number']}")
             alert = add_alert(f"⚠️ Suspicious SIM-swap attempt detected for {sim['number']}", "warn")
             if not sim["locked"]:
                 sim["locked"] = True
-                sim["last"] = "Auto-locked on risk • " + now_iso()
+                sim["last"] = f"Auto-locked on risk • {now_iso()}"
+                bump_version()
                 add_log(f"{sim['number']} auto-locked due to risk")
                 auto_alert = add_alert(f"Auto-locked {sim['number']} due to high risk", "danger")
-                await manager.broadcast({"type":"alert","payload": alert})
-                await manager.broadcast({"type":"alert","payload": auto_alert})
+                # both go out in the same batch frame
+                manager.broadcast({"type":"alert","payload": alert})
+                manager.broadcast({"type":"alert","payload": auto_alert})
             else:
-                await manager.broadcast({"type":"alert","payload": alert})
+                manager.broadcast({"type":"alert","payload": alert})
         else:
             new_number = f"07{random.randint(100000000,999999999)}"
             entry = {"id": f"reg-{str(uuid.uuid4())[:8]}", "number": new_number, "relation":"Unknown", "risk": random.choice(["low","medium","high"])}
             state["registered"].insert(0, entry)
+            bump_version()
             add_log(f"New SIM {new_number} registered to your ID on remote ISP")
             alert = add_alert(f"New SIM {new_number} registered to your ID — auto-frozen pending review", "danger")
-            new_sim = {"id": str(uuid.uuid4()), "number": new_number, "locked": True, "last": "Auto-locked on registration • " + now_iso()}
-            state["sims"].insert(0, new_sim)
+            new_sim = {"id": str(uuid.uuid4()), "number": new_number, "locked": True, "last": f"Auto-locked on registration • {now_iso()}"}
+            state["sims"].appendleft(new_sim)
+            state["sims_by_id"][new_sim["id"]] = new_sim
+            bump_version()
             add_log(f"Auto-added and locked {new_number} to local SIM list")
-            await manager.broadcast({"type":"alert","payload": alert})
-            await manager.broadcast({"type":"state","payload": {"sims": state["sims"], "registered": state["registered"]}})
+            manager.broadcast({"type":"alert","payload": alert})
+            app.state.state_dirty.set()
 
-# Start simulator on startup
-@app.on_event("startup")
-async def start_simulator():
-    asyncio.create_task(simulator_loop())
+# Coalesces state changes into at most one full state broadcast per window
+async def state_broadcaster():
+    while True:
+        await app.state.state_dirty.wait()
+        app.state.state_dirty.clear()
+        await asyncio.sleep(0.25)
+        manager.broadcast({"type":"state","payload": {"sims": list(state["sims"]), "registered": state["registered"]}})